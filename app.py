@@ -1,11 +1,11 @@
 import streamlit as st
 import pandas as pd
-import yfinance as yf
+import numpy as np
 from datetime import date
 
 # Import the functions from your existing backend scripts
 from portfolio_constructor import build_portfolio
-from backtester import run_backtest, calculate_performance_metrics
+from backtester import run_backtest, calculate_performance_metrics, get_benchmark_returns, EXECUTOR
 
 # --- Page Configuration ---
 st.set_page_config(
@@ -21,6 +21,19 @@ def cached_run_backtest(risk_profile, weighting_scheme, start_date, end_date, nu
     """A cached version of the backtest function."""
     return run_backtest(risk_profile, weighting_scheme, start_date, end_date, num_stocks)
 
+@st.cache_data
+def build_chart_df(strategy_returns, benchmark_returns):
+    """Cumulative growth of strategy and benchmark, cached so unrelated reruns skip the rebuild."""
+    if isinstance(strategy_returns, pd.DataFrame): strategy_returns = strategy_returns.iloc[:, 0]
+    if isinstance(benchmark_returns, pd.DataFrame): benchmark_returns = benchmark_returns.iloc[:, 0]
+
+    # Align both series once, then fill a single (days x 2) array of cumulative growth
+    chart_index = strategy_returns.index.union(benchmark_returns.index)
+    chart = np.empty((len(chart_index), 2))
+    chart[:, 0] = np.cumprod(1.0 + strategy_returns.reindex(chart_index).fillna(0).to_numpy())
+    chart[:, 1] = np.cumprod(1.0 + benchmark_returns.reindex(chart_index).fillna(0).to_numpy())
+    return pd.DataFrame(chart, index=chart_index, columns=['Strategy', 'Benchmark'])
+
 # --- Main Application ---
 st.title("📈 Quantitative Multi-Factor Portfolio Strategy")
 st.write("""
@@ -90,11 +103,12 @@ if 'portfolio_df' in st.session_state and st.session_state.portfolio_df is not N
             START_DATE = '2020-01-01'
             END_DATE = date.today().strftime('%Y-%m-%d')
             
+            # Fetch the benchmark in the background while the strategy backtest runs
+            benchmark_future = EXECUTOR.submit(get_benchmark_returns, BENCHMARK_TICKER, START_DATE, END_DATE)
+            
             # --- CHANGE IS HERE: Passing all three user parameters to the backtester ---
             strategy_returns = cached_run_backtest(selected_profile, selected_weighting, START_DATE, END_DATE, num_stocks)
-            
-            benchmark_data = yf.download(BENCHMARK_TICKER, start=START_DATE, end=END_DATE, progress=False, auto_adjust=True)
-            benchmark_returns = benchmark_data['Close'].pct_change().dropna()
+            benchmark_returns = benchmark_future.result()
             
             st.subheader("Performance Metrics")
             col1, col2 = st.columns(2)
@@ -113,12 +127,4 @@ if 'portfolio_df' in st.session_state and st.session_state.portfolio_df is not N
             
             st.subheader("Portfolio Growth (Cumulative Returns)")
             
-            if isinstance(strategy_returns, pd.DataFrame): strategy_returns = strategy_returns.iloc[:, 0]
-            if isinstance(benchmark_returns, pd.DataFrame): benchmark_returns = benchmark_returns.iloc[:, 0]
-            
-            chart_df = pd.DataFrame({
-                'Strategy': (1 + strategy_returns).cumprod(),
-                'Benchmark': (1 + benchmark_returns).cumprod()
-            })
-            
-            st.line_chart(chart_df)
+            st.line_chart(build_chart_df(strategy_returns, benchmark_returns))
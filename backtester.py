@@ -1,107 +1,244 @@
 import sqlite3
+import sys
 import pandas as pd
 import numpy as np
 import yfinance as yf
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from datetime import date, timedelta
+from joblib import Memory
+from numba import njit
 from tqdm import tqdm
 
 DB_NAME = 'quant_portfolio.db'
 
+# Shared pool for independent network downloads (e.g. benchmark vs strategy prices)
+EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
+# On-disk cache of price downloads, so Streamlit reruns and repeated backtests skip the network.
+# The end date is usually today, so every day adds a new entry; old and excess entries are evicted.
+memory = Memory('.yf_cache', verbose=0)
+CACHE_AGE_LIMIT = timedelta(days=7)
+CACHE_BYTES_LIMIT = '500M'
+
 # --- Replicated Logic from portfolio_constructor.py for consistency ---
 FACTOR_WEIGHTS = {
     'conservative': {'value_score': 0.15, 'quality_score': 0.40, 'momentum_score': 0.05, 'low_volatility_score': 0.40},
     'balanced': {'value_score': 0.25, 'quality_score': 0.25, 'momentum_score': 0.25, 'low_volatility_score': 0.25},
     'aggressive': {'value_score': 0.40, 'quality_score': 0.15, 'momentum_score': 0.40, 'low_volatility_score': 0.05}
 }
+SCORE_COLS = ['value_score', 'quality_score', 'momentum_score', 'low_volatility_score']
+# Each profile's weights as a vector in SCORE_COLS order, built once at import.
+# float32 throughout the scoring path: the scores are 1-6 hexiles, so single precision ranks them the same
+WEIGHTS_ARR = {profile: np.array([weights[col] for col in SCORE_COLS], dtype=np.float32) for profile, weights in FACTOR_WEIGHTS.items()}
 
 def calculate_composite_score(scores_df, risk_profile):
-    weights = FACTOR_WEIGHTS[risk_profile]
-    scores_df['composite_score'] = (
-        scores_df['value_score'].fillna(0) * weights['value_score'] +
-        scores_df['quality_score'].fillna(0) * weights['quality_score'] +
-        scores_df['momentum_score'].fillna(0) * weights['momentum_score'] +
-        scores_df['low_volatility_score'].fillna(0) * weights['low_volatility_score']
-    )
-    return scores_df
-
-def build_portfolio_for_date(target_date, risk_profile, num_stocks):
-    conn = None
-    try:
-        conn = sqlite3.connect(DB_NAME)
-        query = f"SELECT s.ticker, fs.* FROM factor_scores fs JOIN stocks s ON s.id = fs.stock_id WHERE fs.date_calculated = '{target_date}'"
-        scores_for_date = pd.read_sql_query(query, conn)
-        
-        if scores_for_date.empty: return None
+    # One matrix-vector product over the score columns (missing scores count as 0),
+    # returned as an array rather than written back into the frame
+    score_matrix = np.nan_to_num(scores_df[SCORE_COLS].to_numpy(dtype=np.float32))
+    return score_matrix @ WEIGHTS_ARR[risk_profile]
 
-        valid_scores = scores_for_date.dropna(subset=['momentum_score']).copy()
-        portfolio_df = valid_scores[valid_scores['momentum_score'] > 3].copy()
+def preload_scores(conn, start_date, end_date):
+    """Reads the factor_scores for a date window in one query and splits it into {date_calculated: scores_df}."""
+    # Ordered by row id so ties in the composite are broken the same way portfolio_constructor does
+    query = "SELECT s.ticker, fs.* FROM factor_scores fs JOIN stocks s ON s.id = fs.stock_id WHERE fs.date_calculated BETWEEN ? AND ? ORDER BY fs.id"
+    # Plain fetchall + from_records skips read_sql_query's per-row dtype inference
+    cur = conn.execute(query, (start_date, end_date))
+    rows = cur.fetchall()
+    all_scores = pd.DataFrame.from_records(rows, columns=[col[0] for col in cur.description])
+    all_scores[SCORE_COLS] = all_scores[SCORE_COLS].astype(np.float32)
+    return dict(list(all_scores.groupby('date_calculated')))
 
-        portfolio_df = calculate_composite_score(portfolio_df, risk_profile)
-        portfolio_df = portfolio_df.sort_values(by='composite_score', ascending=False)
-        
-        return portfolio_df.head(num_stocks)
-    finally:
-        if conn: conn.close()
+def build_portfolio_for_date(scores_by_date, target_date, risk_profile, num_stocks):
+    scores_for_date = scores_by_date.get(target_date)
+    if scores_for_date is None or scores_for_date.empty: return None
 
-def get_stock_prices(tickers, start_date, end_date):
-    """Gets historical prices and cleans out any stocks that fail to download."""
-    prices = yf.download(tickers, start=start_date, end=end_date, progress=False, auto_adjust=True)['Close']
+    # Filter before scoring so only the survivors are multiplied and sorted;
+    # a missing momentum score compares False, so those rows drop out here too
+    portfolio_df = scores_for_date[scores_for_date['momentum_score'].to_numpy() > 3]
+
+    # Integer scores times two-decimal weights are exact to 2 places; rounding there stops
+    # float error (e.g. 3.8499999 vs 3.85) from deciding what are really ties
+    composite = np.round(calculate_composite_score(portfolio_df, risk_profile), 2)
+    top_rows = np.argsort(-composite, kind='stable')[:num_stocks]
+    
+    return portfolio_df.iloc[top_rows]
+
+def download_prices(tickers, start_date, end_date):
+    """Downloads close prices for a list of tickers in one batched request (not cached)."""
+    prices = yf.download(list(tickers), start=start_date, end=end_date, progress=False, auto_adjust=True, group_by='column', threads=True)['Close']
     if isinstance(prices, pd.Series):
         prices = prices.to_frame(name=tickers[0] if tickers else 'data')
+    return prices
+
+@memory.cache(ignore=['downloaded'])
+def cached_ticker_prices(ticker, start_date, end_date, downloaded=None):
+    """
+    One ticker's close prices, cached on disk per (ticker, start, end). get_stock_prices
+    fills the cache by passing in the series it already downloaded in a batch.
+    """
+    if downloaded is not None:
+        return downloaded
+    return download_prices([ticker], start_date, end_date)[ticker]
+
+def get_stock_prices(tickers, start_date, end_date):
+    """Gets historical prices and cleans out any stocks that fail to download."""
+    start_date = pd.Timestamp(start_date)
+    end_date = pd.Timestamp(end_date)
+
+    # De-duplicate so repeated tickers neither hit yfinance twice nor get cached twice
+    tickers = sorted(set(tickers))
+
+    # Each ticker has its own cache entry, so only the ones not cached yet are downloaded,
+    # together in one batch
+    missing = [ticker for ticker in tickers if not cached_ticker_prices.check_call_in_cache(ticker, start_date, end_date)]
+    failed = set()
+    if missing:
+        batch = download_prices(missing, start_date, end_date)
+        for ticker in missing:
+            # yfinance reports a failed or rate-limited ticker as an all-NaN column; leave it
+            # uncached so the next run retries just that ticker instead of replaying the failure
+            if ticker not in batch.columns or batch[ticker].isna().all():
+                failed.add(ticker)
+            else:
+                cached_ticker_prices(ticker, start_date, end_date, downloaded=batch[ticker])
+        if failed:
+            print(f"No price data for {len(failed)} ticker(s): {', '.join(sorted(failed))}")
+        memory.reduce_size(bytes_limit=CACHE_BYTES_LIMIT, age_limit=CACHE_AGE_LIMIT)
+
+    series = [cached_ticker_prices(ticker, start_date, end_date).rename(ticker) for ticker in tickers if ticker not in failed]
+    if not series:
+        return pd.DataFrame()
+    prices = pd.concat(series, axis=1).sort_index()
     return prices.dropna(axis=1, how='all')
 
+def slice_prices(prices, tickers, start_date, end_date):
+    """Cuts a [start, end) window for the given tickers out of the pre-downloaded prices, like yf.download would."""
+    in_window = (prices.index >= start_date) & (prices.index < end_date)
+    window = prices.loc[in_window, prices.columns.intersection(tickers)]
+    return window.dropna(axis=1, how='all')
+
+def get_benchmark_returns(ticker, start_date, end_date):
+    """Downloads the benchmark index and returns its daily returns."""
+    benchmark_data = yf.download(ticker, start=start_date, end=end_date, progress=False, auto_adjust=True)
+    return benchmark_data['Close'].pct_change().dropna()
+
 def calculate_weights(prices, scheme='equal'):
     """Calculates portfolio weights based on the chosen scheme."""
     if scheme == 'equal':
         return pd.Series(1 / len(prices.columns), index=prices.columns)
     elif scheme == 'inverse_volatility':
-        returns = prices.pct_change(fill_method=None).dropna()
-        volatility = returns.std()
-        volatility = volatility.replace(0, np.nan) # Avoid division by zero
-        inverse_vol = 1 / volatility
-        return inverse_vol / inverse_vol.sum()
+        # Log returns in one NumPy pass; nanstd skips each stock's missing days without a dropna copy
+        log_returns = np.diff(np.log(prices.to_numpy(dtype=np.float64)), axis=0)
+        volatility = np.nanstd(log_returns, axis=0, ddof=1)
+        volatility[volatility == 0] = np.nan # Avoid division by zero
+        inverse_vol = 1.0 / volatility
+        return pd.Series(inverse_vol / np.nansum(inverse_vol), index=prices.columns)
+
+@njit(cache=True)
+def portfolio_returns(daily_returns, weights):
+    """Weighted sum of the stock returns for each day (rows are days, columns are stocks, one weight row per day)."""
+    out = np.empty(daily_returns.shape[0])
+    for i in range(daily_returns.shape[0]):
+        total = 0.0
+        for j in range(daily_returns.shape[1]):
+            total += daily_returns[i, j] * weights[i, j]
+        out[i] = total
+    return out
+
+@njit(cache=True)
+def return_stats(returns):
+    """Single pass over a return series: compounded growth, mean and sample variance (NaNs skipped)."""
+    growth = 1.0
+    mean = 0.0
+    m2 = 0.0
+    n = 0
+    for r in returns:
+        if np.isnan(r):
+            continue
+        n += 1
+        growth *= 1.0 + r
+        delta = r - mean
+        mean += delta / n
+        m2 += delta * (r - mean)
+    variance = m2 / (n - 1) if n > 1 else np.nan
+    return growth, mean, variance
 
 def run_backtest(risk_profile, weighting_scheme, start_date_str, end_date_str, num_stocks=20):
     start_date = pd.to_datetime(start_date_str)
     end_date = pd.to_datetime(end_date_str)
     rebalance_dates = pd.date_range(start=start_date, end=end_date, freq='BQS')
-    all_returns = []
 
     print(f"\n--- Starting Backtest (Profile: '{risk_profile}', Weighting: {weighting_scheme}) ---")
-    
-    for i in tqdm(range(len(rebalance_dates) - 1), desc="Backtesting Quarters"):
+
+    # One read-only connection for the whole backtest, opened and closed exactly once
+    with closing(sqlite3.connect(DB_NAME)) as conn:
+        conn.execute('PRAGMA query_only=1')
+        scores_by_date = preload_scores(conn, start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'))
+
+    # Pick every quarter's portfolio first (in memory) so all prices can be fetched in one download
+    portfolios = {}
+    for rebalance_date in rebalance_dates[:-1]:
+        portfolio_df = build_portfolio_for_date(scores_by_date, rebalance_date.strftime('%Y-%m-%d'), risk_profile, num_stocks)
+        if portfolio_df is not None and not portfolio_df.empty:
+            portfolios[rebalance_date] = portfolio_df['ticker'].tolist()
+    if not portfolios: return pd.Series(dtype=float)
+
+    all_tickers = sorted({ticker for tickers in portfolios.values() for ticker in tickers})
+    full_prices = get_stock_prices(all_tickers, start_date - timedelta(days=365), end_date)
+
+    # Vectorized like vectorbt: daily returns for the whole (days x stocks) price grid, plus a matching
+    # target-weight matrix filled in per quarter, then a single pass over both at the end
+    prices = full_prices.to_numpy(dtype=np.float64)
+    daily_returns = np.full_like(prices, np.nan)
+    daily_returns[1:] = (prices[1:] - prices[:-1]) / prices[:-1]
+    target_weights = np.zeros_like(prices)
+    held = np.zeros(prices.shape, dtype=bool)
+    in_period = np.zeros(len(prices), dtype=bool)
+
+    # No progress bar when stderr isn't a terminal (e.g. under Streamlit or with redirected logs)
+    for i in tqdm(range(len(rebalance_dates) - 1), desc="Backtesting Quarters", disable=not sys.stderr.isatty()):
         rebalance_date = rebalance_dates[i]
         period_end = rebalance_dates[i+1]
-        
-        portfolio_df = build_portfolio_for_date(rebalance_date.strftime('%Y-%m-%d'), risk_profile, num_stocks)
-        if portfolio_df is None or portfolio_df.empty: continue
 
-        tickers = portfolio_df['ticker'].tolist()
-        
+        tickers = portfolios.get(rebalance_date)
+        if not tickers: continue
+
         # Get historical prices to calculate weights
-        prices_for_weights = get_stock_prices(tickers, rebalance_date - timedelta(days=365), rebalance_date)
+        prices_for_weights = slice_prices(full_prices, tickers, rebalance_date - timedelta(days=365), rebalance_date)
         if prices_for_weights.empty: continue
         
         weights = calculate_weights(prices_for_weights, weighting_scheme)
         
         # Get prices for the actual holding period
-        prices_for_returns = get_stock_prices(weights.index.tolist(), rebalance_date, period_end)
+        prices_for_returns = slice_prices(full_prices, weights.index.tolist(), rebalance_date, period_end)
         if prices_for_returns.empty: continue
             
-        daily_returns = prices_for_returns.pct_change(fill_method=None).dropna()
-        period_portfolio_returns = (daily_returns * weights).sum(axis=1)
-        all_returns.append(period_portfolio_returns)
+        # The period earns returns from the day after its first trading day up to (not including) period_end
+        period_rows = slice(full_prices.index.searchsorted(rebalance_date) + 1, full_prices.index.searchsorted(period_end))
+        held_cols = full_prices.columns.get_indexer(prices_for_returns.columns)
+
+        # Stocks without a usable weight (e.g. zero volatility) contribute nothing, as in a skipna sum
+        target_weights[period_rows, held_cols] = weights.reindex(prices_for_returns.columns).fillna(0).to_numpy(dtype=np.float64)
+        held[period_rows, held_cols] = True
+        in_period[period_rows] = True
 
-    if not all_returns: return pd.Series(dtype=float)
-    return pd.concat(all_returns)
+    # Days where any held stock is missing a price are dropped
+    complete_days = in_period & ~(np.isnan(daily_returns) & held).any(axis=1)
+    if not complete_days.any(): return pd.Series(dtype=float)
+
+    held_returns = np.where(held[complete_days], daily_returns[complete_days], 0.0)
+    strategy_returns = portfolio_returns(held_returns, target_weights[complete_days])
+    return pd.Series(strategy_returns, index=full_prices.index[complete_days])
 
 def calculate_performance_metrics(returns):
     # ... (This is the final, robust version from before)
     if returns.empty or len(returns) < 2: return {metric: "N/A" for metric in ["Total Return", "Annualized Return (CAGR)", "Annualized Volatility", "Sharpe Ratio"]}
     if isinstance(returns, pd.DataFrame): returns = returns.iloc[:, 0]
-    total_return = (1 + returns).prod() - 1
+    growth, _, variance = return_stats(returns.to_numpy(dtype=np.float64))
+    total_return = growth - 1
     annualized_return = ((1 + total_return) ** (252 / len(returns))) - 1
-    annualized_volatility = returns.std() * np.sqrt(252)
+    annualized_volatility = np.sqrt(variance) * np.sqrt(252)
     sharpe_ratio = annualized_return / annualized_volatility if annualized_volatility != 0 else 0.0
     return {"Total Return": f"{total_return:.2%}", "Annualized Return (CAGR)": f"{annualized_return:.2%}", "Annualized Volatility": f"{annualized_volatility:.2%}", "Sharpe Ratio": f"{sharpe_ratio:.2f}"}
 
@@ -121,10 +258,10 @@ def main():
     END_DATE = date.today().strftime('%Y-%m-%d')
     BENCHMARK_TICKER = '^NSEI'
 
+    # The benchmark download is independent of the strategy, so let it run while the backtest does
+    benchmark_future = EXECUTOR.submit(get_benchmark_returns, BENCHMARK_TICKER, START_DATE, END_DATE)
     strategy_returns = run_backtest(risk_profile, weighting_scheme, START_DATE, END_DATE)
-    
-    benchmark_data = yf.download(BENCHMARK_TICKER, start=START_DATE, end=END_DATE, progress=False, auto_adjust=True)
-    benchmark_returns = benchmark_data['Close'].pct_change().dropna()
+    benchmark_returns = benchmark_future.result()
     
     print("\n--- Strategy Performance ---")
     print(calculate_performance_metrics(strategy_returns))
@@ -1,6 +1,7 @@
 import sqlite3
 import pandas as pd
 import os 
+from functools import lru_cache
 
 def get_snp500_tickers():
     ''' 
@@ -26,10 +27,12 @@ def get_snp500_tickers():
         print(f"Error fetching S&P500 : {e}")
         return None
 
+@lru_cache(maxsize=1)
 def get_nifty50_tickers_from_csv():
     """
     Reads the NIFTY 50 tickers from a local CSV file.
     This version is more robust and cleans column names automatically.
+    The CSV is parsed once per process; treat the returned DataFrame as read-only.
     """
     csv_filename = 'ind_nifty50list.csv'
     print(f"Reading NIFTY 50 tickers from local file: '{csv_filename}'...")
@@ -38,20 +41,28 @@ def get_nifty50_tickers_from_csv():
         print(f"[ERROR] The file '{csv_filename}' was not found.")
         return None
 
+    required_cols = ['Company Name', 'Industry', 'Symbol']
     try:
-        nifty50_df = pd.read_csv(csv_filename)
+        # Read just the header first, so the printout below shows every column the file has
+        original_columns = pd.read_csv(csv_filename, nrows=0).columns.tolist()
+        wanted_cols = [col for col in original_columns if col.strip() in required_cols]
+
+        # Only parse the columns we use (matched after stripping spaces) and keep symbols as plain strings
+        nifty50_df = pd.read_csv(
+            csv_filename,
+            usecols=wanted_cols,
+            dtype={col: str for col in wanted_cols},
+        )
         
         # --- THE BULLETPROOF FIX IS HERE ---
         # 1. Clean up all column names: remove leading/trailing spaces
-        original_columns = nifty50_df.columns.tolist()
-        nifty50_df.columns = [col.strip() for col in nifty50_df.columns]
-        cleaned_columns = nifty50_df.columns.tolist()
+        nifty50_df.rename(columns=str.strip, inplace=True)
+        cleaned_columns = [col.strip() for col in original_columns]
         
         print("\nOriginal columns read from CSV:", original_columns)
         print("Cleaned columns for processing:", cleaned_columns)
         
         # 2. Check if required columns exist after cleaning
-        required_cols = ['Company Name', 'Industry', 'Symbol']
         if not all(col in nifty50_df.columns for col in required_cols):
             print("\n[CRITICAL ERROR] Even after cleaning, one of the required columns is missing.")
             print(f"The script needs: {required_cols}")
@@ -83,6 +94,7 @@ def create_database_tables(conn):
             DROP TABLE IF EXISTS stocks;
             DROP TABLE IF EXISTS fundamental_data;
             DROP TABLE IF EXISTS daily_prices;
+            DROP TABLE IF EXISTS factor_scores;
                         
         CREATE TABLE stocks(
             id  INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
@@ -111,6 +123,21 @@ def create_database_tables(conn):
             FOREIGN KEY(stock_id) REFERENCES stocks(id),
             UNIQUE (stock_id,date)
         );
+
+        CREATE TABLE factor_scores(
+            id  INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+            stock_id INTEGER NOT NULL,
+            date_calculated DATE NOT NULL,
+            value_score INTEGER,
+            quality_score INTEGER,
+            momentum_score INTEGER,
+            low_volatility_score INTEGER,
+            FOREIGN KEY(stock_id) REFERENCES stocks(id),
+            UNIQUE (stock_id,date_calculated)
+        );
+
+        -- the backtester looks scores up by date every quarter
+        CREATE INDEX IF NOT EXISTS idx_fs_date_stock ON factor_scores(date_calculated, stock_id);
                     ''')
     
         conn.commit()
@@ -124,13 +151,13 @@ def filling_stocks_table(conn,tickers_df):
     the fuction fills the stocks table in db with all the ticker info"""
     print("populating 'stocks' table")
     try:
-        cur=conn.cursor()
-        for index,row in tickers_df.iterrows():
-            cur.execute('''
+        rows = list(zip(tickers_df['ticker'], tickers_df['company_name'], tickers_df['sector']))
+        # one executemany inside a single transaction instead of an execute per row
+        with conn:
+            conn.executemany('''
         INSERT OR IGNORE INTO stocks(ticker,company_name,sector) VALUES (?, ?, ?)
-        ''',(row['ticker'],row['company_name'],row['sector']))
-            
-        conn.commit()
+        ''',rows)
+
         print(f"stocks table has now been populated with {len(tickers_df)} tickers")
     except Exception as e:
         print(f"there is an error: {e}") 
@@ -143,6 +170,9 @@ def main():
     if nifty50_tickers is not None:
         try:
             conn = sqlite3.connect(db_name)
+            # WAL journal + NORMAL sync cuts the fsync cost of every commit
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
             print("database successsfully connected")
 
             create_database_tables(conn)
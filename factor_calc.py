@@ -1,8 +1,10 @@
 import sqlite3
+import numpy as np
 import pandas as pd
 from datetime import date
 
 DB_NAME = 'quant_portfolio.db'
+FUNDAMENTAL_COLS = ['pe_ratio', 'pb_ratio', 'roe', 'debt_equity']
 
 def create_factor_scores_table(conn):
     try:
@@ -20,10 +22,38 @@ def create_factor_scores_table(conn):
                 UNIQUE (stock_id, date_calculated)
             )
         ''')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_fs_date_stock ON factor_scores (date_calculated, stock_id)')
         conn.commit()
     except Exception as e:
         print(f"Error creating factor_scores table: {e}")
 
+FACTOR_INDEXES = {
+    # the 550-day price window filters on date alone
+    'idx_dp_date': 'CREATE INDEX IF NOT EXISTS idx_dp_date ON daily_prices (date)',
+    # the latest-fundamentals subquery groups by stock_id and takes MAX(date_recorded)
+    'idx_fd_stock_date': 'CREATE INDEX IF NOT EXISTS idx_fd_stock_date ON fundamental_data (stock_id, date_recorded)',
+}
+
+def ensure_indexes(conn):
+    """
+    Creates the indexes the factor queries lean on. A full ANALYZE scans every table, so it
+    only runs when an index was just created; otherwise PRAGMA optimize re-analyzes only
+    what SQLite thinks has gone stale.
+    (stock_id, date) on daily_prices is already covered by its UNIQUE constraint.
+    """
+    try:
+        cur = conn.cursor()
+        existing = {row[0] for row in cur.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        for create_sql in FACTOR_INDEXES.values():
+            cur.execute(create_sql)
+        if FACTOR_INDEXES.keys() - existing:
+            cur.execute('ANALYZE')
+        else:
+            cur.execute('PRAGMA optimize')
+        conn.commit()
+    except Exception as e:
+        print(f"Error creating indexes: {e}")
+
 def get_data(conn):
     """
     Retrieves all necessary raw data from the database.
@@ -33,7 +63,38 @@ def get_data(conn):
     
     # --- FIX IS HERE: Widen the data window to ~18 months (550 days) ---
     # This provides a large buffer and makes the momentum calculation robust.
-    prices_query = "SELECT stock_id, date, close_price FROM daily_prices WHERE date >= date('now', '-550 days')"
+    # Momentum and volatility are worked out by SQLite's window functions, so only
+    # one row per stock comes back instead of every daily price.
+    price_factors_query = """
+    WITH px AS (
+        SELECT stock_id, close_price,
+               LAG(close_price, 21) OVER w AS price_1m_ago,
+               LAG(close_price, 63) OVER w AS price_3m_ago,
+               LAG(close_price, 126) OVER w AS price_6m_ago,
+               LAG(close_price, 252) OVER w AS price_12m_ago,
+               close_price / LAG(close_price) OVER w - 1 AS daily_return,
+               ROW_NUMBER() OVER (PARTITION BY stock_id ORDER BY date DESC) AS rn
+        FROM daily_prices
+        WHERE date >= date('now', '-550 days')
+        WINDOW w AS (PARTITION BY stock_id ORDER BY date)
+    ),
+    rets AS (
+        SELECT stock_id, COUNT(daily_return) AS n, SUM(daily_return) AS s1, SUM(daily_return * daily_return) AS s2
+        FROM px
+        GROUP BY stock_id
+    )
+    SELECT px.stock_id,
+           -- Composite momentum (from the notion notes, a common weighting scheme):
+           -- 12m_return * 0.4 + 6m_return * 0.3 + 3m_return * 0.2 + 1m_return * 0.1
+           (close_price - price_12m_ago) / price_12m_ago * 0.4
+         + (close_price - price_6m_ago) / price_6m_ago * 0.3
+         + (close_price - price_3m_ago) / price_3m_ago * 0.2
+         + (close_price - price_1m_ago) / price_1m_ago * 0.1 AS momentum_raw,
+           CASE WHEN n > 1 THEN (s2 - s1 * s1 / n) / (n - 1) END AS return_variance
+    FROM px JOIN rets ON rets.stock_id = px.stock_id
+    WHERE rn = 1
+    ORDER BY px.stock_id
+    """
     
     fundamentals_query = """
     SELECT f.*
@@ -46,88 +107,87 @@ def get_data(conn):
     """
     
     stocks_df = pd.read_sql_query(stocks_query, conn)
-    prices_df = pd.read_sql_query(prices_query, conn, parse_dates=['date'])
+    price_factors_df = pd.read_sql_query(price_factors_query, conn)
     fundamentals_df = pd.read_sql_query(fundamentals_query, conn)
+    # Every factor ends up as a 1-6 bucket, so float32 is plenty and halves what the ranking sorts move
+    fundamentals_df[FUNDAMENTAL_COLS] = fundamentals_df[FUNDAMENTAL_COLS].astype(np.float32)
+
+    #---Low Volatility Score---
+    # 1-year standard deviation of daily returns; the square root is taken here so
+    # the query does not depend on SQLite being built with its math functions
+    variance = price_factors_df.pop('return_variance').to_numpy(dtype=np.float64)
+    price_factors_df['volatility_raw'] = np.sqrt(np.maximum(variance, 0))
+    price_factors_df[['momentum_raw', 'volatility_raw']] = price_factors_df[['momentum_raw', 'volatility_raw']].astype(np.float32)
     
-    return stocks_df, prices_df, fundamentals_df
+    return stocks_df, price_factors_df, fundamentals_df
 
-def calculate_factors(stocks_df, prices_df, fundamentals_df):
-    print("Calculating factors...")
+def group_starts(stock_ids):
+    """
+    Start offset of every stock's block in a stock_id-sorted array, closed off with len(stock_ids).
+    """
+    if len(stock_ids) == 0:
+        return np.zeros(1, dtype=np.intp)
+    return np.r_[0, np.flatnonzero(np.diff(stock_ids)) + 1, len(stock_ids)]
 
-    #---Momentum factor---
-    prices_df = prices_df.sort_values(by=['stock_id', 'date'])
-   
-    trading_day_periods = {
-        '1m': 21,
-        '3m': 63,
-        '6m': 126,
-        '12m': 252
-    }
-    for name, days in trading_day_periods.items():
-        prices_df[f'price_{name}_ago'] = prices_df.groupby('stock_id')['close_price'].shift(days)
-   
-
-    latest_prices = prices_df.groupby('stock_id').last().reset_index()
-
-    for name, days in trading_day_periods.items():
-        latest_prices[f'return_{name}'] = (latest_prices['close_price'] - latest_prices[f'price_{name}_ago']) / latest_prices[f'price_{name}_ago']
-
-    #the above is just a simple calculation of %return = current price-old price/old price
-
-    latest_prices['momentum_raw'] =(
-        latest_prices['return_12m'] * 0.4 + 
-        latest_prices['return_6m'] * 0.3 + 
-        latest_prices['return_3m'] * 0.2 + 
-        latest_prices['return_1m'] * 0.1
-    )
+def fast_rank(values, ascending=True):
+    """
+    Ordinal ranks 1..N from one argsort, with every missing value tied last at N.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind != 'f':
+        values = values.astype(np.float64)
+    order = np.argsort(values if ascending else -values, kind='stable')
+    ranks = np.empty(len(values), dtype=np.int64)
+    ranks[order] = np.arange(1, len(values) + 1)
+    ranks[np.isnan(values)] = len(values)
+    return ranks
+
+def hexile_scores(ranks):
+    """
+    Maps ranks 1..N onto Hexile scores 1-6 as ceil(rank / N * 6), without pd.qcut's sort and bin search.
+    """
+    ranks = np.asarray(ranks, dtype=np.float64)
+    return np.clip(np.ceil(ranks / len(ranks) * 6), 1, 6).astype(np.int8)
 
-    """ copied from notion notes A common weighting scheme is:
-    
-        - **12-month return:** 40% weight
-        - **6-month return:** 30% weight
-        - **3-month return:** 20% weight
-        - **1-month return:** 10% weight
+def calculate_factors(stocks_df, price_factors_df, fundamentals_df):
+    """
+    Combines the per-stock price factors from get_data with the fundamentals and
+    turns every factor into a 1-6 Hexile score.
+    """
+    print("Calculating factors...")
 
-        **Composite Momentum Score = (12m_return * 0.4) + (6m_return * 0.3) + (3m_return * 0.2) + (1m_return * 0.1)**
-        """
-    
-    #---Low Volatility Score---
-    # 1-year standard deviation of daily returns
-    prices_df['daily_return'] = prices_df.groupby('stock_id')['close_price'].pct_change()
-    volatility = prices_df.groupby('stock_id')['daily_return'].std().reset_index()
-    volatility.rename(columns={'daily_return': 'volatility_raw'}, inplace=True)
-    
     # Merge factors into a single DataFrame
-    factors_df = pd.merge(stocks_df, fundamentals_df, left_on='id', right_on='stock_id', how='left')
-    factors_df = pd.merge(factors_df, latest_prices[['stock_id', 'momentum_raw']], on='stock_id', how='left')
-    factors_df = pd.merge(factors_df, volatility, on='stock_id', how='left')
+    # Every frame is keyed by stock_id, so one index-aligned join replaces the chain of merges
+    factors_df = stocks_df.set_index('id').rename_axis('stock_id').join(
+        [fundamentals_df.set_index('stock_id'), price_factors_df.set_index('stock_id')], how='left').reset_index()
 
     # --- 3. Ranking and Scaling ---
     print("Ranking and scaling factors...")
     
-    # Create ranks for each factor. `na_option='bottom'` is crucial for handling NULLs.
+    # Create ranks for each factor. fast_rank puts NULLs at the bottom, which is crucial for handling them.
     # Value Ranks
-    factors_df['pe_rank'] = factors_df['pe_ratio'].rank(ascending=True, na_option='bottom')
-    factors_df['pb_rank'] = factors_df['pb_ratio'].rank(ascending=True, na_option='bottom')
+    factors_df['pe_rank'] = fast_rank(factors_df['pe_ratio'], ascending=True)
+    factors_df['pb_rank'] = fast_rank(factors_df['pb_ratio'], ascending=True)
     
     # Quality Ranks
-    factors_df['roe_rank'] = factors_df['roe'].rank(ascending=False, na_option='bottom')
-    factors_df['de_rank'] = factors_df['debt_equity'].rank(ascending=True, na_option='bottom')
+    factors_df['roe_rank'] = fast_rank(factors_df['roe'], ascending=False)
+    factors_df['de_rank'] = fast_rank(factors_df['debt_equity'], ascending=True)
 
     # Momentum and Volatility Ranks
-    factors_df['momentum_rank'] = factors_df['momentum_raw'].rank(ascending=False, na_option='bottom')
-    factors_df['volatility_rank'] = factors_df['volatility_raw'].rank(ascending=True, na_option='bottom')
+    factors_df['momentum_rank'] = fast_rank(factors_df['momentum_raw'], ascending=False)
+    factors_df['volatility_rank'] = fast_rank(factors_df['volatility_raw'], ascending=True)
 
       # Average the sub-factor ranks to get the final factor ranks
     factors_df['value_rank_final'] = factors_df[['pe_rank', 'pb_rank']].mean(axis=1)
     factors_df['quality_rank_final'] = factors_df[['roe_rank', 'de_rank']].mean(axis=1)
 
     # Convert final ranks to Hexile Scores (1-6)
-    # `pd.qcut` divides the data into N equal-sized groups (quantiles)
-    factors_df['value_score'] = pd.qcut(factors_df['value_rank_final'], 6, labels=False, duplicates='drop') + 1
-    factors_df['quality_score'] = pd.qcut(factors_df['quality_rank_final'], 6, labels=False, duplicates='drop') + 1
-    factors_df['momentum_score'] = pd.qcut(factors_df['momentum_rank'], 6, labels=False, duplicates='drop') + 1
-    factors_df['low_volatility_score'] = pd.qcut(factors_df['volatility_rank'], 6, labels=False, duplicates='drop') + 1
+    # Ranks run 1..N, so each sixth of them is one score bucket; the averaged
+    # value/quality ranks are re-ranked first so they spread over 1..N as well
+    factors_df['value_score'] = hexile_scores(fast_rank(factors_df['value_rank_final']))
+    factors_df['quality_score'] = hexile_scores(fast_rank(factors_df['quality_rank_final']))
+    factors_df['momentum_score'] = hexile_scores(factors_df['momentum_rank'])
+    factors_df['low_volatility_score'] = hexile_scores(factors_df['volatility_rank'])
     
     # Prepare final DataFrame for saving
     final_scores = factors_df[['stock_id', 'value_score', 'quality_score', 'momentum_score', 'low_volatility_score']].copy()
@@ -163,10 +223,11 @@ def main():
         print(f"Connected to database '{DB_NAME}'.")
         
         create_factor_scores_table(conn)
+        ensure_indexes(conn)
         
-        stocks, prices, fundamentals = get_data(conn)
+        stocks, price_factors, fundamentals = get_data(conn)
         
-        final_scores_df = calculate_factors(stocks, prices, fundamentals)
+        final_scores_df = calculate_factors(stocks, price_factors, fundamentals)
         
         save_scores_to_db(conn, final_scores_df)
         
@@ -1,20 +1,129 @@
 import sqlite3
+import numpy as np
 import pandas as pd
 from datetime import date
+from numba import njit, prange
 from tqdm import tqdm
 
+from factor_calc import FUNDAMENTAL_COLS, ensure_indexes, group_starts, fast_rank, hexile_scores
+
 DB_NAME = 'quant_portfolio.db'
+PRICE_WINDOW_DAYS = 550
+# Longest lag first, which is also the order the momentum terms are summed in
+TRADING_DAY_PERIODS = {'12m': 252, '6m': 126, '3m': 63, '1m': 21}
+MOMENTUM_WEIGHTS = {'12m': 0.4, '6m': 0.3, '3m': 0.2, '1m': 0.1}
 
-def calculate_factors_for_date(target_date_str, conn):
+def load_price_history(conn, first_date, last_date):
     """
-    Calculates all factor scores from raw data available up to a specific historical date.
-    MODIFIED: It now uses the LATEST available fundamental data for all periods.
+    Pulls every price the whole backfill needs in one query and keeps it as flat
+    stock_id/date sorted NumPy arrays. Returns None when there are no prices in the range.
+    """
+    query = "SELECT stock_id, date, close_price FROM daily_prices WHERE date >= ? AND date <= ? ORDER BY stock_id, date"
+    start_str = (first_date - pd.DateOffset(days=PRICE_WINDOW_DAYS)).strftime('%Y-%m-%d')
+    rows = conn.execute(query, (start_str, last_date.strftime('%Y-%m-%d'))).fetchall()
+    if not rows:
+        return None
+
+    # Straight from the sqlite3 tuples into typed arrays, without building a DataFrame first
+    stock_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    days = np.array([row[1] for row in rows], dtype='datetime64[D]').astype(np.int64)
+    close = np.fromiter((row[2] for row in rows), dtype=np.float64, count=len(rows))
+    starts = group_starts(stock_ids)
+
+    # Daily returns for the whole history in one diff-divide; each stock's first
+    # row has no previous day of its own, so its return is blanked out
+    returns = np.empty_like(close)
+    returns[0] = np.nan
+    returns[1:] = close[1:] / close[:-1] - 1
+    returns[starts[:-1]] = np.nan
+
+    return {
+        'stock_ids': stock_ids[starts[:-1]],
+        'starts': starts,
+        'days': days,
+        'close': close,
+        'returns': returns,
+    }
+
+@njit(parallel=True, cache=True, error_model='numpy')
+def price_factor_kernel(starts, days, close, returns, target_days, window_days, lags, lag_weights):
+    """
+    Momentum and volatility for every (target date, stock) pair, one stock per thread.
+    Each stock's window is the rows dated (target - window_days) .. target; stocks with
+    no rows in a window are flagged in has_prices.
+    """
+    n_dates = len(target_days)
+    n_stocks = len(starts) - 1
+    momentum = np.full((n_dates, n_stocks), np.nan)
+    volatility = np.full((n_dates, n_stocks), np.nan)
+    has_prices = np.zeros((n_dates, n_stocks), dtype=np.bool_)
+
+    for g in prange(n_stocks):
+        base = starts[g]
+        block_days = days[base:starts[g + 1]]
+        for q in range(n_dates):
+            lo = base + np.searchsorted(block_days, target_days[q] - window_days)
+            hi = base + np.searchsorted(block_days, target_days[q], side='right')
+            if hi <= lo:
+                continue
+            has_prices[q, g] = True
+
+            latest = hi - 1
+            if latest - lags.max() >= lo:
+                total = 0.0
+                for k in range(len(lags)):
+                    price_ago = close[latest - lags[k]]
+                    total += (close[latest] - price_ago) / price_ago * lag_weights[k]
+                momentum[q, g] = total
+
+            # Two passes over the window's returns (row lo's return reaches back before it)
+            n = 0
+            mean = 0.0
+            for i in range(lo + 1, hi):
+                if not np.isnan(returns[i]):
+                    n += 1
+                    mean += returns[i]
+            if n > 1:
+                mean /= n
+                ss = 0.0
+                for i in range(lo + 1, hi):
+                    if not np.isnan(returns[i]):
+                        ss += (returns[i] - mean) ** 2
+                volatility[q, g] = np.sqrt(ss / (n - 1))
+
+    return momentum, volatility, has_prices
+
+def price_factors_for_dates(price_history, target_dates):
+    """
+    Momentum and volatility of every stock over the 550 days up to each target date,
+    computed for all dates in one kernel call. Returns {target_date: DataFrame}.
+    """
+    columns = ['stock_id', 'momentum_raw', 'volatility_raw']
+    if price_history is None:
+        return {target_date: pd.DataFrame(columns=columns) for target_date in target_dates}
+
+    target_days = np.asarray(target_dates.values.astype('datetime64[D]').astype(np.int64))
+    lags = np.array(list(TRADING_DAY_PERIODS.values()), dtype=np.int64)
+    lag_weights = np.array([MOMENTUM_WEIGHTS[name] for name in TRADING_DAY_PERIODS], dtype=np.float64)
+    momentum, volatility, has_prices = price_factor_kernel(
+        price_history['starts'], price_history['days'], price_history['close'], price_history['returns'],
+        target_days, PRICE_WINDOW_DAYS, lags, lag_weights)
+
+    price_factors = {}
+    for q, target_date in enumerate(target_dates):
+        rows = has_prices[q]
+        price_factors[target_date] = pd.DataFrame({
+            'stock_id': price_history['stock_ids'][rows],
+            'momentum_raw': momentum[q, rows].astype(np.float32),
+            'volatility_raw': volatility[q, rows].astype(np.float32),
+        })
+    return price_factors
+
+def load_fundamentals(conn):
+    """
+    Reads the stocks list and the LATEST fundamental snapshot of every stock. Neither
+    depends on the target date, so main reads them once for the whole backfill.
     """
-    target_date = pd.to_datetime(target_date_str)
-    
-    # Prices query remains point-in-time
-    prices_query = f"SELECT stock_id, date, close_price FROM daily_prices WHERE date <= '{target_date_str}' AND date >= '{ (target_date - pd.DateOffset(days=550)).strftime('%Y-%m-%d') }'"
-    
     # --- FIX IS HERE: This query now gets the single most recent fundamental snapshot ---
     fundamentals_query = """
     SELECT f.* FROM fundamental_data f
@@ -22,41 +131,36 @@ def calculate_factors_for_date(target_date_str, conn):
     ON f.stock_id = fm.stock_id AND f.date_recorded = fm.max_date
     """
     stocks_df = pd.read_sql_query("SELECT id as stock_id, ticker FROM stocks", conn)
-    prices_df = pd.read_sql_query(prices_query, conn, parse_dates=['date'])
     fundamentals_df = pd.read_sql_query(fundamentals_query, conn)
+    fundamentals_df[FUNDAMENTAL_COLS] = fundamentals_df[FUNDAMENTAL_COLS].astype(np.float32)
+    return stocks_df, fundamentals_df
 
-    if prices_df.empty or fundamentals_df.empty:
+def calculate_factors_for_date(target_date_str, stocks_df, fundamentals_df, price_factors):
+    """
+    Calculates all factor scores from raw data available up to a specific historical date.
+    MODIFIED: It now uses the LATEST available fundamental data for all periods.
+    Momentum and volatility come in precomputed as price_factors (see price_factors_for_dates).
+    """
+    if price_factors.empty or fundamentals_df.empty:
         print(f"Warning: Missing price or fundamental data for {target_date_str}. Cannot generate scores.")
         return None
 
-    # ... (The rest of the calculation logic remains exactly the same) ...
-    prices_df = prices_df.sort_values(by=['stock_id', 'date'])
-    trading_day_periods = {'1m': 21, '3m': 63, '6m': 126, '12m': 252}
-    for name, days in trading_day_periods.items():
-        prices_df[f'price_{name}_ago'] = prices_df.groupby('stock_id')['close_price'].shift(days)
-    
-    latest_prices = prices_df.groupby('stock_id').last().reset_index()
-    for name in trading_day_periods:
-        latest_prices[f'return_{name}'] = (latest_prices['close_price'] - latest_prices[f'price_{name}_ago']) / latest_prices[f'price_{name}_ago']
+    # Every frame is keyed by stock_id, so one index-aligned join replaces the chain of merges
+    factors_df = stocks_df.set_index('stock_id').join(
+        [fundamentals_df.set_index('stock_id'), price_factors.set_index('stock_id')], how='left').reset_index()
     
-    latest_prices['momentum_raw'] = (latest_prices['return_12m']*0.4 + latest_prices['return_6m']*0.3 + latest_prices['return_3m']*0.2 + latest_prices['return_1m']*0.1)
+    # Rank each sub-factor, then average, the same way factor_calc scores today's snapshot
+    value_rank = (fast_rank(factors_df['pe_ratio'], ascending=True) + fast_rank(factors_df['pb_ratio'], ascending=True)) / 2
+    quality_rank = (fast_rank(factors_df['roe'], ascending=False) + fast_rank(factors_df['debt_equity'], ascending=True)) / 2
+    factors_df['value_rank'] = fast_rank(value_rank)
+    factors_df['quality_rank'] = fast_rank(quality_rank)
+    factors_df['momentum_rank'] = fast_rank(factors_df['momentum_raw'], ascending=False)
+    factors_df['volatility_rank'] = fast_rank(factors_df['volatility_raw'], ascending=True)
     
-    prices_df['daily_return'] = prices_df.groupby('stock_id')['close_price'].pct_change()
-    volatility = prices_df.groupby('stock_id')['daily_return'].std().reset_index().rename(columns={'daily_return': 'volatility_raw'})
-    
-    factors_df = pd.merge(stocks_df, fundamentals_df, on='stock_id', how='left')
-    factors_df = pd.merge(factors_df, latest_prices[['stock_id', 'momentum_raw']], on='stock_id', how='left')
-    factors_df = pd.merge(factors_df, volatility, on='stock_id', how='left')
-    
-    factors_df['value_rank'] = factors_df[['pe_ratio', 'pb_ratio']].mean(axis=1).rank(ascending=True, na_option='bottom')
-    factors_df['quality_rank'] = factors_df[['roe', 'debt_equity']].mean(axis=1).rank(ascending=False, na_option='bottom')
-    factors_df['momentum_rank'] = factors_df['momentum_raw'].rank(ascending=False, na_option='bottom')
-    factors_df['volatility_rank'] = factors_df['volatility_raw'].rank(ascending=True, na_option='bottom')
-    
-    factors_df['value_score'] = pd.qcut(factors_df['value_rank'], 6, labels=False, duplicates='drop') + 1
-    factors_df['quality_score'] = pd.qcut(factors_df['quality_rank'], 6, labels=False, duplicates='drop') + 1
-    factors_df['momentum_score'] = pd.qcut(factors_df['momentum_rank'], 6, labels=False, duplicates='drop') + 1
-    factors_df['low_volatility_score'] = pd.qcut(factors_df['volatility_rank'], 6, labels=False, duplicates='drop') + 1
+    factors_df['value_score'] = hexile_scores(factors_df['value_rank'])
+    factors_df['quality_score'] = hexile_scores(factors_df['quality_rank'])
+    factors_df['momentum_score'] = hexile_scores(factors_df['momentum_rank'])
+    factors_df['low_volatility_score'] = hexile_scores(factors_df['volatility_rank'])
 
     final_scores = factors_df[['stock_id', 'value_score', 'quality_score', 'momentum_score', 'low_volatility_score']].copy()
     final_scores['date_calculated'] = target_date_str
@@ -64,7 +168,14 @@ def calculate_factors_for_date(target_date_str, conn):
     return final_scores
 
 def save_scores_to_db(conn, scores_df):
-    scores_df.to_sql('factor_scores', conn, if_exists='append', index=False)
+    """
+    Inserts the scores; the caller owns the transaction (see main).
+    """
+    rows = scores_df[['stock_id', 'date_calculated', 'value_score', 'quality_score', 'momentum_score', 'low_volatility_score']].itertuples(index=False, name=None)
+    conn.executemany('''
+        INSERT INTO factor_scores (stock_id, date_calculated, value_score, quality_score, momentum_score, low_volatility_score)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', rows)
 
 def main():
     """
@@ -78,21 +189,41 @@ def main():
     # Generate a list of dates for the first business day of each QUARTER
     dates_to_process = pd.date_range(start=start_date, end=end_date, freq='BQS') # Business Quarter Start
 
-    conn = sqlite3.connect(DB_NAME)
-    
-    # Clean the slate before starting
-    print("Deleting all existing factor scores to start fresh...")
-    conn.cursor().execute("DELETE FROM factor_scores")
-    conn.commit()
+    # Autocommit mode, so the delete + insert below is exactly one explicit transaction
+    conn = sqlite3.connect(DB_NAME, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    ensure_indexes(conn)
+
+    stocks_df, fundamentals_df = load_fundamentals(conn)
+
+    # One price pull covers every quarter's 550-day window
+    print("Loading price history for all periods...")
+    price_history = load_price_history(conn, dates_to_process.min(), dates_to_process.max())
+    price_factors = price_factors_for_dates(price_history, dates_to_process)
 
     print(f"Starting QUARTERLY historical factor generation for {len(dates_to_process)} periods...")
+    all_scores = []
     for target_date in tqdm(dates_to_process, desc="Generating Quarterly Scores"):
         target_date_str = target_date.strftime('%Y-%m-%d')
         
-        scores_df = calculate_factors_for_date(target_date_str, conn)
+        scores_df = calculate_factors_for_date(target_date_str, stocks_df, fundamentals_df, price_factors[target_date])
         
         if scores_df is not None and not scores_df.empty:
-            save_scores_to_db(conn, scores_df)
+            all_scores.append(scores_df)
+    
+    # Clear the old scores and write every quarter in one transaction: one sync to disk,
+    # and readers never see the table half rebuilt
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        print("Deleting all existing factor scores to start fresh...")
+        conn.execute("DELETE FROM factor_scores")
+        if all_scores:
+            save_scores_to_db(conn, pd.concat(all_scores, ignore_index=True))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
     
     conn.close()
     print("Quarterly historical factor generation complete.")
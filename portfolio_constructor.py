@@ -25,35 +25,49 @@ FACTOR_WEIGHTS = {
     }
 }
 
-def get_latest_factor_scores(conn):
+# The same recipes as SQL expressions, so SQLite can score, sort and cut the portfolio itself
+COMPOSITE_SQL = {
+    profile: ' + '.join(f"fs.{col} * {weight}" for col, weight in weights.items())
+    for profile, weights in FACTOR_WEIGHTS.items()
+}
+
+def get_latest_score_date(conn):
+    """
+    Returns the date of the most recent set of factor scores (served from the date index).
+    """
+    return conn.execute("SELECT MAX(date_calculated) FROM factor_scores").fetchone()[0]
+
+def count_latest_factor_scores(conn, score_date):
     """
-    Retrieves the most recent set of factor scores for all stocks.
+    Counts the stocks in the given set of factor scores, before and after the momentum filter.
     """
     query = """
-    SELECT s.ticker, fs.*
-    FROM factor_scores fs
-    JOIN stocks s ON s.id = fs.stock_id
-    WHERE fs.date_calculated = (SELECT MAX(date_calculated) FROM factor_scores)
+    SELECT COUNT(*), COALESCE(SUM(momentum_score > 3), 0)
+    FROM factor_scores
+    WHERE date_calculated = ?
     """
-    return pd.read_sql_query(query, conn)
+    return conn.execute(query, (score_date,)).fetchone()
 
-def calculate_composite_score(scores_df, risk_profile):
+def get_top_stocks(conn, score_date, risk_profile, num_stocks):
     """
-    Calculates the composite score based on the selected risk profile.
+    Scores the factor scores of the given date for the risk profile and returns the top N stocks,
+    with the momentum filter, sort and limit all done inside SQLite. Integer scores times
+    two-decimal weights are exact to 2 places, so rounding there makes equal composites compare
+    equal; ties are then kept in factor_scores row order, the same tie-break the backtester uses.
     """
-    if risk_profile not in FACTOR_WEIGHTS:
+    if risk_profile not in COMPOSITE_SQL:
         raise ValueError("Invalid risk profile specified.")
-        
-    weights = FACTOR_WEIGHTS[risk_profile]
-    
-    # Calculate the weighted average score
-    scores_df['composite_score'] = (
-        scores_df['value_score'] * weights['value_score'] +
-        scores_df['quality_score'] * weights['quality_score'] +
-        scores_df['momentum_score'] * weights['momentum_score'] +
-        scores_df['low_volatility_score'] * weights['low_volatility_score']
-    )
-    return scores_df
+
+    query = f"""
+    SELECT s.ticker, fs.*, ROUND({COMPOSITE_SQL[risk_profile]}, 2) AS composite_score
+    FROM factor_scores fs
+    JOIN stocks s ON s.id = fs.stock_id
+    WHERE fs.date_calculated = ?
+      AND fs.momentum_score > 3
+    ORDER BY composite_score DESC, fs.id
+    LIMIT ?
+    """
+    return pd.read_sql_query(query, conn, params=(score_date, num_stocks))
 
 def build_portfolio(risk_profile='balanced', num_stocks=30):
     """
@@ -70,22 +84,16 @@ def build_portfolio(risk_profile='balanced', num_stocks=30):
     try:
         conn = sqlite3.connect(DB_NAME)
         
-        # 1. Get the latest scores
-        latest_scores = get_latest_factor_scores(conn)
-        
-        # 2. Calculate composite scores based on risk profile
-        portfolio_df = calculate_composite_score(latest_scores, risk_profile)
-        
+        # Look the latest date up once instead of re-running MAX() as a subquery in every query
+        latest_date = get_latest_score_date(conn)
+
         #This is a crucial rule to avoid buying stocks that are in a strong downtrend.
+        num_considered, num_after_filter = count_latest_factor_scores(conn, latest_date)
+        print(f"\nOriginal number of stocks considered: {num_considered}")
+        print(f"Number of stocks after applying momentum filter: {num_after_filter}")
         
-        print(f"\nOriginal number of stocks considered: {len(portfolio_df)}")
-        portfolio_df = portfolio_df[portfolio_df['momentum_score'] > 3]
-        print(f"Number of stocks after applying momentum filter: {len(portfolio_df)}")
-        
-       
-        portfolio_df = portfolio_df.sort_values(by='composite_score', ascending=False)
-        
-        return portfolio_df.head(num_stocks)
+        # Composite score, momentum filter, sort and top-N selection all run in SQL
+        return get_top_stocks(conn, latest_date, risk_profile, num_stocks)
         
     except Exception as e:
         print(f"An error occurred: {e}")
@@ -3,10 +3,13 @@
 import sqlite3
 import yfinance as yf
 import pandas as pd
+import numpy as np
 from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 
 DB_name='quant_portfolio.db'
+INFO_WORKERS = 16
 
 def get_stock(conn):
     cur=conn.cursor()
@@ -25,45 +28,70 @@ def get_last_price(conn,stock_id):
 def fetch_n_save_price_data(conn):
     tickers_info= get_stock(conn)
     default_start_date = date(2010, 1, 1)
-    print(f"Fetching price data for {len(tickers_info)} tickers...")
-
+    end_date = date.today()
+    all_rows = []
+
+    # Determine the start date for every ticker's download
+    start_map = {}
+    for stock_id, ticker in tickers_info:
+        last_date = get_last_price(conn,stock_id)
+        if last_date:
+            start_date = last_date + timedelta(days=1)
+        else:
+            start_date = default_start_date
+        '''the above tells me that if last date exists in daily prices then 
+             the start date is last date + 1 day
+             else its the default start date
+        '''
+        #fetching only if the start date is before end date
+        if start_date< end_date:
+            start_map[ticker] = (stock_id, start_date)
+
+    print(f"Fetching price data for {len(start_map)} tickers...")
+    if not start_map:
+        return
+
+    # One batched download from the earliest start date replaces a request per ticker;
+    # each ticker is then cut back to its own start date below
+    global_start = min(start_date for _, start_date in start_map.values())
+    data = yf.download(list(start_map), start=global_start, end=end_date, group_by='ticker', threads=True, progress=False, auto_adjust=True)
+    #Returns a Pandas DataFrame with one column block per ticker:
+    #Open, High, Low, Close, Volume
+    downloaded = set(data.columns.get_level_values(0))
 
     # Using tqdm for a progress bar
-    for stock_id, ticker in tqdm(tickers_info, desc="Updating Prices"):
+    for ticker, (stock_id, start_date) in tqdm(start_map.items(), desc="Updating Prices"):
         try:
-            last_date = get_last_price(conn,stock_id)
-            
-            # Determine the start date for the download
-            if last_date:
-                start_date = last_date + timedelta(days=1)
-            else:
-                start_date = default_start_date
-            '''the above tells me that if last date exists in daily prices then 
-                 the start date is last date + 1 day
-                 else its the default start date
-            '''
-            end_date = date.today()
-
-            #fetching only if the start date is before end date
-            if start_date< end_date:
-                data = yf.download(ticker,start=start_date,end=end_date,progress=False,auto_adjust=True)
-                #Returns a Pandas DataFrame with columns like:
-                #Open, High, Low, Close, Adj Close, Volume
-                if not data.empty:
-                    #if the data returned isnt empty we should
-                    data.rename(columns={'Close':'close_price','Volume':'volume'},inplace=True)
-        
-                data['stock_id'] = stock_id
-
-                data_to_save = data[['stock_id', 'close_price', 'volume']].reset_index()
+            if ticker not in downloaded:
+                continue
+            ticker_data = data[ticker].loc[pd.Timestamp(start_date):].dropna(subset=['Close'])
+            if not ticker_data.empty:
+                #if the data returned isnt empty we should
+                ticker_data = ticker_data.rename(columns={'Close':'close_price','Volume':'volume'})
+    
+                ticker_data['stock_id'] = stock_id
+
+                data_to_save = ticker_data[['stock_id', 'close_price', 'volume']].reset_index()
                 data_to_save.columns = ['date', 'stock_id', 'close_price', 'volume']
-                data_to_save['date'] = data_to_save['date'].dt.strftime('%Y-%m-%d')
+                # one C-level conversion per ticker instead of a strftime call per row
+                data_to_save['date'] = np.datetime_as_string(data_to_save['date'].to_numpy(dtype='datetime64[D]'))
 
-                data_to_save.to_sql('daily_prices', conn, if_exists='append', index=False)
-        
+                # collect the rows here and write every ticker in one go after the loop
+                all_rows.extend(data_to_save.itertuples(index=False, name=None))
+    
         except Exception as e:
             print(f"Error fetching data for {ticker}: {e}")
 
+    # one executemany inside a single transaction instead of a to_sql call per ticker
+    # (total_changes only counts inserted rows, not the duplicates OR IGNORE skipped)
+    changes_before = conn.total_changes
+    with conn:
+        conn.executemany('''
+            INSERT OR IGNORE INTO daily_prices (date, stock_id, close_price, volume)
+            VALUES (?, ?, ?, ?)
+        ''', all_rows)
+    print(f"Saved {conn.total_changes - changes_before} new price rows ({len(all_rows)} submitted).")
+
 ###############################################################################################################################
 ###############################################################################################################################
 ###############################################################################################################################
@@ -75,41 +103,51 @@ def fetch_and_save_fundamental_data(conn):
     cur=conn.cursor()
 
     today_str = date.today().strftime('%Y-%m-%d')
+    all_rows = []
+
+    # Stocks that already have today's snapshot, loaded once instead of checked one by one
+    existing = {row[0] for row in cur.execute("SELECT stock_id FROM fundamental_data WHERE date_recorded = ?", (today_str,))}
 
     print("\nFetching fundamental data...")
 
-    for stock_id,ticker in tqdm(tickers_info,desc="UPDATING FUNDAMENTALS"):
-        try:
-            cur.execute("""
-            SELECT id FROM fundamental_data 
-            WHERE stock_id = ? AND date_recorded = ?
-            """,(stock_id, today_str))
+    # each .info access is a blocking HTTPS call, so run them side by side
+    with ThreadPoolExecutor(max_workers=INFO_WORKERS) as executor:
+        futures = {executor.submit(lambda t=ticker: yf.Ticker(t).info): (stock_id, ticker)
+                   for stock_id, ticker in tickers_info if stock_id not in existing}
 
-            if cur.fetchone() is not None:
-                continue
+        for future in tqdm(as_completed(futures), total=len(futures), desc="UPDATING FUNDAMENTALS"):
+            stock_id, ticker = futures[future]
+            try:
+                info = future.result()
 
-            stock_info = yf.Ticker(ticker)
-            info = stock_info.info
+                pe_ratio=info.get('trailingPE',None)
+                pb_ratio = info.get('priceToBook', None)
+                roe = info.get('returnOnEquity', None)
+                debt_equity = info.get('debtToEquity', None)
 
-            pe_ratio=info.get('trailingPE',None)
-            pb_ratio = info.get('priceToBook', None)
-            roe = info.get('returnOnEquity', None)
-            debt_equity = info.get('debtToEquity', None)
+                all_rows.append((stock_id, today_str, pe_ratio, pb_ratio, roe, debt_equity))
 
-            cur.execute('''
-                INSERT INTO fundamental_data 
-                (stock_id, date_recorded, pe_ratio, pb_ratio, roe, debt_equity)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (stock_id, today_str, pe_ratio, pb_ratio, roe, debt_equity))
+            except Exception as e:
+                print(f"Error fetching fundamental data for {ticker}: {e}")
 
-        except Exception as e:
-            print(f"Error fetching fundamental data for {ticker}: {e}")
+    # results arrive in completion order; insert them in the stocks table order
+    order = {stock_id: i for i, (stock_id, _) in enumerate(tickers_info)}
+    all_rows.sort(key=lambda row: order[row[0]])
 
-    conn.commit()
+    with conn:
+        conn.executemany('''
+            INSERT INTO fundamental_data 
+            (stock_id, date_recorded, pe_ratio, pb_ratio, roe, debt_equity)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', all_rows)
 
 def main():
     try:
         conn = sqlite3.connect(DB_name)
+        # cheaper commits and in-memory temp tables for the bulk inserts below
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
         print(f"Connected to database '{DB_name}'.")
          
         fetch_n_save_price_data(conn)